@@ -1,37 +1,114 @@
 # Auto generates thumbnails relative to a given directory.
 
 # stdlib imports
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from functools import lru_cache
 from pathlib import Path
 import argparse
+import asyncio
 import atexit
 import json
 import logging.config
 import multiprocessing as mp
 import os
+import shutil
+import struct
+import subprocess
 import time
 
 # Third party 
-from botocore.exceptions import ClientError
+from boto3.exceptions import S3UploadFailedError
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
 from dotenv import load_dotenv
-from exif import Image
 import boto3
+import httpx
+import piexif
 import pyvips as pv
-import requests
+
+# Optional: libjpeg-turbo IDCT scaling and libavif encoding for the JPEG fast path
+try:
+    from turbojpeg import TJPF_RGB, TurboJPEG
+    import imagecodecs
+except ImportError:
+    TurboJPEG = None
 
 # Default thumbnail generation values
 DEFAULT_WIDTH = 1000
 DEFAULT_QUALITY = 75
-DEFAULT_EFFORT = 4
+DEFAULT_EFFORT = 2
+DEFAULT_ENCODER = "svt"
+DEFAULT_FORMAT = "avif"
+
+# Camera recorded for photos without EXIF data (film scans)
+DEFAULT_CAMERA_MODEL = "OLYMPUS XA2"
+
+# Thumbnail output formats and AV1 encoders selectable by libheif
+THUMBNAIL_FORMATS = ("avif", "webp")
+AV1_ENCODERS = ("auto", "aom", "rav1e", "svt")
+WEBP_MAX_EFFORT = 6
+
+# Minimum seconds between thumbnail progress updates
+PROGRESS_INTERVAL = 0.25
+
+# libvips CLI used for batched thumbnail generation, and source images passed per invocation
+VIPSTHUMBNAIL = "vipsthumbnail"
+VIPSTHUMBNAIL_BATCH_SIZE = 256
+
+# Bytes read from the start of a source image when looking for its EXIF (APP1) segment
+EXIF_READ_LIMIT = 128 * 1024
+EXIF_HEADER = b"Exif\x00\x00"
+ICC_HEADER = b"ICC_PROFILE\x00"
+
+# Sources eligible for the libjpeg-turbo fast path, and libavif's speed for effort 0 (as in libvips)
+JPEG_SUFFIXES = (".jpg", ".jpeg")
+AVIF_MAX_SPEED = 9
+
+# Content types for thumbnails uploaded straight from memory
+THUMBNAIL_CONTENT_TYPES = {".avif": "image/avif", ".webp": "image/webp"}
+
+# Concurrent uploads to object storage, and HTTP connections kept open for them
+UPLOAD_WORKERS = 16
+UPLOAD_POOL_CONNECTIONS = 32
 
 # Cloudflare D1 parameter limit per batch query
 BATCH_PARAM_LIMIT = 100
 
+# Photo metadata table, and the insert statement for a full batch of rows
+PHOTO_TABLE = "photo"
+PHOTO_COLUMNS = ("filename", "thumbnail", "camera_model", "lens", "date_taken", "exposure_time", "focal_length", "f_stop", "iso")
+PHOTO_BATCH_ROWS = BATCH_PARAM_LIMIT // len(PHOTO_COLUMNS)
+PHOTO_ROW_PLACEHOLDER = f"({", ".join("?" * len(PHOTO_COLUMNS))})"
+# Metadata columns filled from EXIF, and their values for photos without it (film scans)
+METADATA_COLUMNS = PHOTO_COLUMNS[2:]
+ROW_DEFAULT = (DEFAULT_CAMERA_MODEL, "NULL", "NULL", "NULL", "NULL", "NULL", "NULL")
+FULL_BATCH_SQL = (f"INSERT INTO {PHOTO_TABLE} ({", ".join(PHOTO_COLUMNS)}) VALUES "
+                  + ",\n".join([PHOTO_ROW_PLACEHOLDER] * PHOTO_BATCH_ROWS)
+                  + " ON CONFLICT DO NOTHING;")
+
+# HTTP connections kept alive to the Cloudflare API, concurrent D1 queries, and per-request timeout (seconds)
+D1_POOL_CONNECTIONS = 16
+D1_WORKERS = 8
+D1_TIMEOUT = 30.0
+# Retries for failed connections and rate-limited or server error responses, with exponential backoff (seconds)
+D1_RETRIES = 5
+D1_RETRY_STATUSES = (429, 500, 502, 503, 504)
+D1_BACKOFF = 0.2
+
+# Environment variables that must be set for uploads to R2 and D1
+UPLOAD_ENV_VARS = ("S3_BUCKET_NAME", "CLOUDFLARE_ACCOUNT_ID", "CLOUDFLARE_D1_ID", "CLOUDFLARE_D1_TOKEN")
+
 logger = logging.getLogger("gallery_util")
 
 load_dotenv()
 
+# Cloudflare D1 endpoint and auth, resolved once from the environment
+D1_URL = f"https://api.cloudflare.com/client/v4/accounts/{os.getenv("CLOUDFLARE_ACCOUNT_ID")}/d1/database/{os.getenv("CLOUDFLARE_D1_ID")}/query"
+D1_HEADERS = {
+    "Content-Type": "application/json",
+    "Authorization": f"Bearer {os.getenv("CLOUDFLARE_D1_TOKEN")}",
+}
+
 def init_logging():
     configFile = Path("logConfig.json")
     with open(configFile) as cf:
@@ -50,10 +127,15 @@ def main():
     parser.add_argument("source", help="Source directory or filename")
     parser.add_argument("-w", "--width", type=int, help="Width of thumbnail to generate (default: 1000px)")
     parser.add_argument("-q", "--quality", type=int, help="Compression factor for thumbnail output (default: 75)")
-    parser.add_argument("-e", "--effort", type=int, help="CPU effort spent improving compression (0: fastest, 9: slowest, 4: default)")
+    parser.add_argument("-e", "--effort", type=int, help="CPU effort spent improving compression (0: fastest, 9: slowest, 2: default)")
+    parser.add_argument("-en", "--encoder", choices=AV1_ENCODERS, default=DEFAULT_ENCODER, help="AV1 encoder used for .avif thumbnails (default: svt)")
+    parser.add_argument("-f", "--format", choices=THUMBNAIL_FORMATS, default=DEFAULT_FORMAT, help="Thumbnail output format (default: avif)")
+    parser.add_argument("-p", "--processes", action="store_true", help="Use a process pool instead of threads for pyvips thumbnail generation")
     parser.add_argument("-c", "--collections", type=str, help="Collection(s) to add photos to (use ; to delimit collections)")
+    parser.add_argument("-o", "--overwrite", action="store_true", help="Regenerate and re-upload images that already have a thumbnail")
     parser.add_argument("-oo", "--offlineOnly", action="store_true", help="Disable uploading and only generate thumbnails locally")
     parser.add_argument("-uo", "--uploadOnly", action="store_true", help="Skip thumbnail generation and only upload to D1 and R2")
+    parser.add_argument("-kl", "--keepLocal", action="store_true", help="Save thumbnails to disk before uploading instead of uploading them straight from memory")
     parser.add_argument("-t", "--test", action="store_true", help="For development testing")
     args = parser.parse_args()
 
@@ -61,10 +143,27 @@ def main():
     width = DEFAULT_WIDTH if not args.width else max(64, int(args.width))
     quality = DEFAULT_QUALITY if not args.quality else max(0, min(100, int(args.quality)))
     effort = DEFAULT_EFFORT if not args.effort else max(0, min(9, int(args.effort)))
-    exportSettings = (width, quality, effort)
+    encoder = get_heif_encoder(args.encoder) if args.format == "avif" else args.encoder
+    exportSettings = (width, quality, effort, encoder)
     sourcePath = Path(args.source)
+    skipExisting = not (args.overwrite or args.uploadOnly) # Upload-only runs need the existing thumbnails
+    streamThumbnails = not (args.offlineOnly or args.uploadOnly or args.keepLocal) # Upload thumbnails without writing them to disk
+
+    # D1_URL and D1_HEADERS are resolved at import, so check the environment before doing any work
+    if not args.offlineOnly:
+        missingEnv = [name for name in UPLOAD_ENV_VARS if not os.getenv(name)]
+        if missingEnv:
+            logger.error(f"Missing environment variables required for uploads: {", ".join(missingEnv)}. Set them in .env or run with -oo.")
+            return 1
+
+    metadata: dict[Path, list[str]] = {} # Map source file to a METADATA_COLUMNS row; absent files use ROW_DEFAULT
 
-    metadata = defaultdict(lambda: defaultdict(lambda: "NULL")) # Map source file to metadata with default value=NULL
+    # boto3 sessions are not thread-safe, so create the shared client before thumbnail threads upload with it
+    if streamThumbnails:
+        get_s3_client()
+
+    # Streamed thumbnails are never written to disk, so existing ones are looked up in object storage
+    storedThumbnails = list_r2_keys() if skipExisting and streamThumbnails else set()
 
     # Generate path for all thumbnails
     pathData = []
@@ -73,16 +172,22 @@ def main():
         logger.info("Path provided is a DIRECTORY")
         sourceDir = sourcePath
         thumbDir = sourceDir / "thumbnails"
-        for filePath in sourceDir.iterdir():
-            if filePath.is_file():
-                thumbPath = thumbDir / ".".join((filePath.name.rsplit(".")[0] + "-thumb", "avif"))
-                pathData.append((filePath, thumbPath))
+        with os.scandir(sourceDir) as entries:
+            for entry in entries:
+                if entry.is_file(follow_symlinks=False):
+                    stem = entry.name.rpartition(".")[0] or entry.name
+                    thumbPath = thumbDir / f"{stem}-thumb.{args.format}"
+                    if skipExisting and (thumbPath.is_file() or thumbPath.name in storedThumbnails):
+                        continue
+                    pathData.append((Path(entry.path), thumbPath))
     else:
         logger.info("Path provided is a FILE")
         sourceDir = sourcePath.parent
         thumbDir = sourceDir / "thumbnails"
-        thumbPath = thumbDir / ".".join((sourcePath.name.rsplit(".")[0] + "-thumb", "avif"))
-        pathData.append((sourcePath, thumbPath))
+        stem = sourcePath.name.rpartition(".")[0] or sourcePath.name
+        thumbPath = thumbDir / f"{stem}-thumb.{args.format}"
+        if not (skipExisting and (thumbPath.is_file() or thumbPath.name in storedThumbnails)):
+            pathData.append((sourcePath, thumbPath))
 
     logger.info(f"Found {len(pathData)} files")
 
@@ -96,21 +201,27 @@ def main():
 
     # Generate thumbnails
     if not args.uploadOnly:
-        thumbnailGenerationData = [(pd, exportSettings) for pd in pathData]
-        thumbDir.mkdir(parents=True, exist_ok=True)
-        generate_thumbnails(thumbnailGenerationData)
+        thumbnailGenerationData = [(pd, exportSettings, streamThumbnails) for pd in pathData]
+        if not streamThumbnails:
+            thumbDir.mkdir(parents=True, exist_ok=True)
+        metadata.update(generate_thumbnails(thumbnailGenerationData, args.processes))
     else:
         logger.info("Thumbnail generation DISABLED")
+        if not args.offlineOnly:
+            for src, _ in pathData:
+                row = extract_metadata(src)
+                if row is not None:
+                    metadata[src] = row
 
     # Upload photos and metadata
     if not args.offlineOnly:
         # Call API to push photo names to DB; return array of id(s) associated with photos
         logger.info("Updating thumbnail path tables...")
-        batch_metadata(pathData)
+        batch_metadata(pathData, metadata)
         
         # Upload photos and thumbnails to R2
         logger.info("Pushing images and thumbnails to object storage...")
-        push_to_r2(pathData)
+        push_to_r2(pathData, includeThumbnails=not streamThumbnails)
 
         # Create linking for photos to collections (optional)
         if args.collections:
@@ -118,46 +229,420 @@ def main():
     else:
         logger.info("File uploads DISABLED")
 
-def generate_thumbnails(thumbnailGenerationData: list[tuple[tuple[Path, Path], tuple[int, int, int]]]) -> None:
+def generate_thumbnails(thumbnailGenerationData: list[tuple[tuple[Path, Path], tuple[int, int, int, str], bool]], useProcesses: bool = False) -> dict[Path, list[str]]:
     """
-    Multiprocess thumbnail generation.
+    Thumbnail generation, batched through the `vipsthumbnail` CLI when available.
+    Returns the EXIF metadata row of each successfully processed source image that has one.
+
+    Falls back to multithreaded generation via `pyvips` otherwise; pyvips releases the GIL
+    while libvips runs, so threads share one warm libvips instance instead of one per process.
+    `useProcesses` switches the fallback to a `forkserver` process pool instead (`spawn` where forkserver
+    is unavailable, e.g. on Windows).
+    Thumbnails streamed to object storage always use `pyvips`, as the CLI can only write files.
     """
     logger.info(f"Beginning thumbnail generation for {len(thumbnailGenerationData)} images")
-    numProcesses = mp.cpu_count()
-    with mp.Pool(numProcesses) as pool:
-        mp.freeze_support()
-        numImages = len(thumbnailGenerationData)
-        counter = 0
-        for _ in pool.imap_unordered(generate_thumbnail, thumbnailGenerationData):
+    if any(stream for _, _, stream in thumbnailGenerationData):
+        logger.info(f"Streaming thumbnails to object storage, which {VIPSTHUMBNAIL} cannot do; using pyvips")
+    elif shutil.which(VIPSTHUMBNAIL) is not None:
+        return generate_thumbnails_cli(thumbnailGenerationData)
+    else:
+        logger.info(f"{VIPSTHUMBNAIL} not found, falling back to pyvips")
+    numWorkers = mp.cpu_count()
+    numImages = len(thumbnailGenerationData)
+    counter = 0
+    lastReport = 0.0
+    metadata = {}
+    if useProcesses:
+        # Workers start from a small server process with pyvips preloaded, instead of a copy of this one
+        if "forkserver" in mp.get_all_start_methods():
+            ctx = mp.get_context("forkserver")
+            ctx.set_forkserver_preload(["pyvips"])
+        else:
+            ctx = mp.get_context("spawn")
+        chunksize = max(1, numImages // (numWorkers * 4))
+        with ctx.Pool(numWorkers, initializer=init_worker) as pool:
+            for sourcePath, row, error in pool.imap_unordered(try_generate_thumbnail, thumbnailGenerationData, chunksize=chunksize):
+                if error is not None:
+                    logger.error(error)
+                elif row is not None:
+                    metadata[sourcePath] = row
+                counter += 1
+                lastReport = report_progress(counter, numImages, lastReport)
+        return metadata
+    init_worker()
+    with ThreadPoolExecutor(max_workers=numWorkers) as executor:
+        futures = [executor.submit(try_generate_thumbnail, data) for data in thumbnailGenerationData]
+        for future in as_completed(futures):
+            sourcePath, row, error = future.result()
+            if error is not None:
+                logger.error(error)
+            elif row is not None:
+                metadata[sourcePath] = row
             counter += 1
-            print(f"processed {counter}/{numImages} images", end="\r")
-        
-def generate_thumbnail(thumbGenData: tuple[tuple[Path, Path], tuple[int, int, int]]) -> None:
+            lastReport = report_progress(counter, numImages, lastReport)
+    return metadata
+
+def init_worker() -> None:
+    """
+    Configures libvips for one-shot thumbnailing; each source image is only read once,
+    so libvips' operation cache is pure overhead.
+
+    The pool already runs one worker per core, so libvips is also limited to a single
+    thread per operation rather than contending for cores with its own thread pool.
+    """
+    pv.cache_set_max(0)
+    pv.cache_set_max_mem(0)
+    pv.cache_set_max_files(0)
+    pv.concurrency_set(1)
+    pv.leak_set(False)
+
+def generate_thumbnails_cli(thumbnailGenerationData: list[tuple[tuple[Path, Path], tuple[int, int, int, str], bool]]) -> dict[Path, list[str]]:
+    """
+    Generates thumbnails by invoking `vipsthumbnail` on batches of source images.
+
+    libvips' internal thread pool provides the parallelism, so decode and encode stay
+    inside a single pipeline instead of crossing the Python boundary per image.
+    EXIF metadata cannot be returned by the CLI, so it is read separately from each source.
+    """
+    env = os.environ | {"VIPS_CONCURRENCY": str(mp.cpu_count())}
+    numImages = len(thumbnailGenerationData)
+    counter = 0
+    lastReport = 0.0
+    metadata = {}
+    for i in range(0, numImages, VIPSTHUMBNAIL_BATCH_SIZE):
+        batch = thumbnailGenerationData[i:i + VIPSTHUMBNAIL_BATCH_SIZE]
+        (_, targetPath), (width, quality, effort, encoder), _ = batch[0]
+        saveOptions = get_save_options(targetPath.suffix, quality, effort, encoder)
+        saveOptionStr = ",".join(f"{key}={value}" for key, value in saveOptions.items())
+        # vipsthumbnail substitutes %s with each source filename minus its extension, and resolves
+        # a relative output path against each source's directory, so the directory must be absolute
+        outputFormat = targetPath.parent.absolute() / f"%s-thumb{targetPath.suffix}[{saveOptionStr}]"
+        command = [VIPSTHUMBNAIL, *(str(sourcePath) for (sourcePath, _), _, _ in batch),
+                   "--size", f"{width}x{width}>", "-o", str(outputFormat)]
+        try:
+            subprocess.run(command, env=env, check=True, capture_output=True, text=True)
+        except subprocess.CalledProcessError as e:
+            logger.error(f"{VIPSTHUMBNAIL} exited with code {e.returncode}: {e.stderr.strip()}")
+        for (sourcePath, _), _, _ in batch:
+            row = extract_metadata(sourcePath)
+            if row is not None:
+                metadata[sourcePath] = row
+        counter += len(batch)
+        lastReport = report_progress(counter, numImages, lastReport)
+    return metadata
+
+def report_progress(counter: int, numImages: int, lastReport: float) -> float:
+    """
+    Prints thumbnail progress at most every `PROGRESS_INTERVAL` seconds, and always for the final image.
+
+    Returns the time of the latest update.
+    """
+    now = time.monotonic()
+    if counter < numImages and now - lastReport < PROGRESS_INTERVAL:
+        return lastReport
+    print(f"processed {counter}/{numImages} images", end="\r")
+    return now
+
+def try_generate_thumbnail(thumbGenData: tuple[tuple[Path, Path], tuple[int, int, int, str], bool]) -> tuple[Path, list[str] | None, str | None]:
+    """
+    Wraps `generate_thumbnail`, returning libvips, file and upload errors (including network failures)
+    instead of raising them so one bad image does not abort the pool. The metadata row is `None` if generation failed.
+
+    Errors are logged by the caller, since process pool workers do not inherit the configured log handlers.
     """
-    Generates an `.avif` thumbnail with export settings applied.
+    try:
+        return *generate_thumbnail(thumbGenData), None
+    except (pv.Error, BotoCoreError, ClientError, OSError) as e:
+        return thumbGenData[0][0], None, f"{thumbGenData[0][0].name}: {e}"
+
+def generate_thumbnail(thumbGenData: tuple[tuple[Path, Path], tuple[int, int, int, str], bool]) -> tuple[Path, list[str] | None]:
     """
-    pathData, exportSettings = thumbGenData
+    Generates an `.avif` or `.webp` thumbnail with export settings applied.
+    If `streamThumbnail` is set, the encoded thumbnail is uploaded to R2 from memory instead of saved to `targetPath`.
+
+    Returns the source path with its EXIF metadata row (`None` without EXIF), read from the image
+    libvips already has open.
+    """
+    pathData, exportSettings, streamThumbnail = thumbGenData
     sourcePath, targetPath = pathData
-    width, quality, effort = exportSettings
-    if (targetPath.is_file()): 
-        logger.debug(f"Skipping thumbnail generation, {targetPath.name} already exists")
-        return
-    thumb: pv.Image = pv.Image.thumbnail(sourcePath, width, size=pv.Size.DOWN)
-    pv.Image.heifsave(thumb, targetPath, Q=quality, compression="av1", effort=effort)
+    width, quality, effort, encoder = exportSettings
+    if TurboJPEG is not None and targetPath.suffix == ".avif" and sourcePath.suffix.lower() in JPEG_SUFFIXES:
+        fastPath = generate_thumbnail_turbojpeg(sourcePath, width, quality, effort, encoder)
+        if fastPath is not None:
+            buffer, exifData = fastPath
+            if streamThumbnail:
+                upload_thumbnail(buffer, targetPath)
+            else:
+                targetPath.write_bytes(buffer)
+            return sourcePath, None if exifData is None else parse_exif(exifData)
+    # thumbnail() opens the source with sequential access, letting the JPEG loader shrink-on-load
+    thumb: pv.Image = pv.Image.thumbnail(str(sourcePath), width, size=pv.Size.DOWN)
+    saveOptions = get_save_options(targetPath.suffix, quality, effort, encoder)
+    if streamThumbnail:
+        upload_thumbnail(pv.Image.write_to_buffer(thumb, targetPath.suffix, **saveOptions), targetPath)
+    else:
+        pv.Image.write_to_file(thumb, str(targetPath), **saveOptions)
+    if thumb.get_typeof("exif-data") == 0:
+        return sourcePath, None
+    return sourcePath, parse_exif(thumb.get("exif-data"))
+
+def generate_thumbnail_turbojpeg(sourcePath: Path, width: int, quality: int, effort: int, encoder: str) -> tuple[bytes, bytes | None] | None:
+    """
+    Fast path for JPEG sources: libjpeg-turbo decodes at the smallest IDCT scale that still covers the
+    thumbnail, and libavif encodes the result without libvips' generic save pipeline.
+
+    Returns the `.avif` bytes and the source's EXIF block, or `None` if the source should go through
+    `pyvips` instead (libjpeg-turbo missing, embedded ICC profile, unsupported colourspace, or no usable encoder).
+    """
+    jpeg = get_turbojpeg()
+    if jpeg is None:
+        return None
+    codec = get_avif_codec(encoder)
+    if codec is None:
+        return None
+    data = sourcePath.read_bytes()
+    # libjpeg-turbo does no colour management, so leave tagged images to libvips; the ICC segment can
+    # follow large EXIF and XMP segments, so the whole file is scanned
+    if find_app_segment(data, 0xE2, ICC_HEADER) is not None:
+        return None
+    exifData = find_app_segment(data, 0xE1, EXIF_HEADER)
+    try:
+        sourceWidth, sourceHeight, _, _ = jpeg.decode_header(data)
+        longSide = max(sourceWidth, sourceHeight)
+        scalingFactor = min((factor for factor in jpeg.scaling_factors
+                             if factor[0] <= factor[1] and longSide * factor[0] >= width * factor[1]),
+                            key=lambda factor: factor[0] / factor[1], default=(1, 1))
+        pixels = jpeg.decode(data, pixel_format=TJPF_RGB, scaling_factor=scalingFactor)
+    except OSError as e:
+        logger.debug(f"libjpeg-turbo cannot decode {sourcePath.name}: {e}")
+        return None
+    thumb: pv.Image = pv.Image.new_from_array(pixels, interpretation="srgb")
+    orientation = get_exif_orientation(exifData)
+    if orientation > 1:
+        thumb = thumb.copy()
+        thumb.set_type(pv.GValue.gint_type, "orientation", orientation)
+        thumb = thumb.autorot()
+    thumb = thumb.thumbnail_image(width, size=pv.Size.DOWN)
+    try:
+        # Workers already run one per core, so each encode stays single-threaded
+        buffer = imagecodecs.avif_encode(thumb.numpy(), level=quality, speed=AVIF_MAX_SPEED - effort, codec=codec, numthreads=1)
+    except imagecodecs.AvifError as e:
+        logger.debug(f"libavif cannot encode {sourcePath.name}: {e}")
+        return None
+    return bytes(buffer), exifData
+
+@lru_cache
+def get_turbojpeg() -> "TurboJPEG | None":
+    """
+    Returns a `TurboJPEG` decoder for this process, or `None` if PyTurboJPEG or libjpeg-turbo is unavailable.
+    """
+    if TurboJPEG is None:
+        return None
+    try:
+        return TurboJPEG()
+    except (OSError, RuntimeError) as e:
+        logger.debug(f"libjpeg-turbo unavailable: {e}")
+        return None
+
+@lru_cache
+def get_avif_codec(encoder: str) -> str | None:
+    """
+    Returns `encoder` if libavif was built with it, otherwise `auto` (libavif's own choice, usually aom),
+    or `None` if libavif cannot encode at all. Stock imagecodecs wheels do not include SVT-AV1.
+    """
+    for codec in dict.fromkeys((encoder, "auto")):
+        if avif_encoder_available(codec):
+            if codec != encoder:
+                logger.info(f"libavif was built without {encoder}, encoding the JPEG fast path with {codec}")
+            return codec
+    return None
 
-def push_to_r2(pathData: tuple[Path, Path]) -> None:
+@lru_cache
+def avif_encoder_available(encoder: str) -> bool:
+    """
+    Returns whether libavif was built with `encoder`, by encoding a tiny test image once per process.
+    """
+    try:
+        imagecodecs.avif_encode(pv.Image.black(8, 8, bands=3).cast(pv.BandFormat.UCHAR).numpy(), codec=encoder)
+        return True
+    except imagecodecs.AvifError as e:
+        logger.debug(f"libavif encoder {encoder} unavailable: {e}")
+        return False
+
+def upload_thumbnail(buffer: bytes, targetPath: Path) -> None:
+    """
+    Uploads an encoded thumbnail to R2 under the name of `targetPath`.
+    """
+    get_s3_client().put_object(Bucket=os.getenv("S3_BUCKET_NAME"), Key=targetPath.name, Body=buffer,
+                               ContentType=THUMBNAIL_CONTENT_TYPES[targetPath.suffix])
+
+def get_heif_encoder(encoder: str) -> str:
+    """
+    Returns `encoder` if libheif was built with it, otherwise `auto` (libheif's own choice, usually aom).
+
+    libvips only warns about a missing encoder, once per saved image, before falling back to its default,
+    so the warning is captured from a tiny test image instead. The pyvips-binary wheels do not include SVT-AV1.
+    """
+    if encoder == "auto":
+        return encoder
+    vipsLogger = logging.getLogger("pyvips")
+    warnings = []
+    handler = logging.Handler(logging.WARNING)
+    handler.emit = warnings.append
+    vipsLogger.addHandler(handler)
+    vipsLogger.propagate = False
+    try:
+        pv.Image.black(8, 8, bands=3).heifsave_buffer(compression="av1", encoder=encoder)
+    finally:
+        vipsLogger.removeHandler(handler)
+        vipsLogger.propagate = True
+    if any(encoder in record.getMessage() for record in warnings):
+        logger.info(f"libheif was built without {encoder}, encoding .avif thumbnails with auto")
+        return "auto"
+    return encoder
+
+def get_save_options(suffix: str, quality: int, effort: int, encoder: str) -> dict[str, int | str]:
+    """
+    Returns libvips save options for a thumbnail with the given file suffix.
+
+    `effort` is capped for `.webp`, whose encoder only accepts 0-6.
+    """
+    if suffix == ".webp":
+        return {"Q": quality, "effort": min(effort, WEBP_MAX_EFFORT)}
+    return {"Q": quality, "compression": "av1", "effort": effort, "encoder": encoder}
+
+def extract_metadata(sourcePath: Path) -> list[str] | None:
+    """
+    Returns the metadata row read from the EXIF block of `sourcePath`, or `None` without EXIF.
+
+    Only the head of the file is read, since JPEG stores EXIF in an APP1 segment right after the SOI marker.
+    """
+    with open(sourcePath, "rb") as f:
+        head = f.read(EXIF_READ_LIMIT)
+    exifData = find_app_segment(head, 0xE1, EXIF_HEADER)
+    if exifData is None:
+        logger.debug(f"No EXIF data found in {sourcePath.name}")
+        return None
+    return parse_exif(exifData)
+
+def find_app_segment(head: bytes, marker: int, header: bytes) -> bytes | None:
+    """
+    Walks the JPEG markers in `head` and returns the payload of the first `marker` (APPn) segment
+    starting with `header`, if any.
+    """
+    if head[:2] != b"\xff\xd8":
+        return None
+    pos = 2
+    while pos + 4 <= len(head) and head[pos] == 0xFF:
+        segmentMarker = head[pos + 1]
+        if segmentMarker == 0xDA: # Start of scan; no metadata segments follow
+            return None
+        length = int.from_bytes(head[pos + 2:pos + 4], "big")
+        if segmentMarker == marker and head[pos + 4:pos + 4 + len(header)] == header:
+            return head[pos + 4:pos + 2 + length]
+        pos += 2 + length
+    return None
+
+def parse_exif(exifData: bytes) -> list[str] | None:
+    """
+    Maps an APP1 EXIF block onto a `METADATA_COLUMNS` row, using `ROW_DEFAULT` for missing or malformed tags.
+    """
+    # piexif treats anything it does not recognise as a filename
+    if not exifData.startswith(EXIF_HEADER):
+        return None
+    try:
+        exif = piexif.load(exifData)
+    except (ValueError, struct.error, piexif.InvalidImageDataError) as e:
+        logger.debug(f"Unable to parse EXIF data: {e}")
+        return None
+    ifd0, exifIfd = exif["0th"], exif["Exif"]
+    metadata = {}
+    if piexif.ImageIFD.Model in ifd0:
+        metadata["camera_model"] = decode_exif_str(ifd0[piexif.ImageIFD.Model])
+    if piexif.ExifIFD.LensModel in exifIfd:
+        metadata["lens"] = decode_exif_str(exifIfd[piexif.ExifIFD.LensModel])
+    if piexif.ExifIFD.DateTimeOriginal in exifIfd:
+        metadata["date_taken"] = decode_exif_str(exifIfd[piexif.ExifIFD.DateTimeOriginal])
+    num, den = exifIfd.get(piexif.ExifIFD.ExposureTime, (0, 0))
+    if den:
+        metadata["exposure_time"] = f"{num}/{den}" if 0 < num < den else f"{num / den:g}"
+    num, den = exifIfd.get(piexif.ExifIFD.FocalLength, (0, 0))
+    if den:
+        metadata["focal_length"] = f"{num / den:g}mm"
+    num, den = exifIfd.get(piexif.ExifIFD.FNumber, (0, 0))
+    if den:
+        metadata["f_stop"] = f"f/{num / den:g}"
+    if piexif.ExifIFD.ISOSpeedRatings in exifIfd:
+        metadata["iso"] = str(exifIfd[piexif.ExifIFD.ISOSpeedRatings])
+    return [metadata.get(column, default) for column, default in zip(METADATA_COLUMNS, ROW_DEFAULT)]
+
+def get_exif_orientation(exifData: bytes | None) -> int:
     """
-    Push source images and thumbnails to R2 via `boto3`
+    Returns the EXIF orientation tag (1-8), defaulting to 1 (upright) if missing or unreadable.
+    """
+    if exifData is None or not exifData.startswith(EXIF_HEADER):
+        return 1
+    try:
+        return piexif.load(exifData)["0th"].get(piexif.ImageIFD.Orientation, 1)
+    except (ValueError, struct.error, piexif.InvalidImageDataError):
+        return 1
+
+def decode_exif_str(value: bytes) -> str:
+    return value.rstrip(b"\x00").decode(errors="replace").strip()
+
+@lru_cache
+def get_s3_client():
+    """
+    Returns a `boto3` S3 client for R2, shared by all threads in this process (clients are thread-safe)
+
+    Creating it is not, so call this once before starting threads that use it.
     """
     logger.info("Connecting to object storage...")
     aws_endpoint_url = os.getenv("AWS_ENDPOINT_URL")
-    s3 = boto3.client("s3", endpoint_url = aws_endpoint_url, region_name="auto")
-    for src, thumb in pathData:
-        try:
-            s3.upload_file(src, os.getenv("S3_BUCKET_NAME"), src.name)
-            s3.upload_file(thumb, os.getenv("S3_BUCKET_NAME"), thumb.name)
-        except ClientError as e:
-            logger.error(e)
+    config = Config(
+        max_pool_connections=UPLOAD_POOL_CONNECTIONS,
+        tcp_keepalive=True,
+        retries={"mode": "adaptive", "max_attempts": 5},
+        s3={"use_accelerate_endpoint": False},
+    )
+    return boto3.client("s3", endpoint_url = aws_endpoint_url, region_name="auto", config=config)
+
+def list_r2_keys() -> set[str]:
+    """
+    Returns the key of every object in the R2 bucket, or an empty set if the bucket cannot be listed.
+    """
+    keys = set()
+    try:
+        for page in get_s3_client().get_paginator("list_objects_v2").paginate(Bucket=os.getenv("S3_BUCKET_NAME")):
+            keys.update(obj["Key"] for obj in page.get("Contents", ()))
+    except ClientError as e:
+        logger.error(f"Unable to list stored thumbnails: {e}")
+        return set()
+    logger.debug(f"Found {len(keys)} objects in object storage")
+    return keys
+
+def push_to_r2(pathData: list[tuple[Path, Path]], includeThumbnails: bool = True) -> None:
+    """
+    Push source images and thumbnails to R2 via `boto3`, uploading concurrently.
+
+    Set `includeThumbnails` to `False` if thumbnails were already streamed to R2 during generation.
+    Thumbnails missing from disk (e.g. streamed by an earlier run) are skipped.
+    """
+    s3 = get_s3_client()
+    bucket = os.getenv("S3_BUCKET_NAME")
+    uploads = [src for src, _ in pathData]
+    if includeThumbnails:
+        thumbnails = [thumb for _, thumb in pathData if thumb.is_file()]
+        if len(thumbnails) < len(pathData):
+            logger.info(f"Skipping {len(pathData) - len(thumbnails)} thumbnails not found on disk")
+        uploads += thumbnails
+    with ThreadPoolExecutor(max_workers=UPLOAD_WORKERS) as executor:
+        futures = [executor.submit(s3.upload_file, path, bucket, path.name) for path in uploads]
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except (S3UploadFailedError, BotoCoreError, ClientError, OSError) as e:
+                logger.error(e)
     logger.info(f"Completed uploading {len(pathData)} images to R2.")
 
 @lru_cache
@@ -166,71 +651,85 @@ def get_multi_insert_query(tableName: str, columns: tuple[str], rowCount: int) -
     Returns a multi-row insert SQL statement with `rowCount` rows
     """
     logger.debug(f"Generating {rowCount} row insert statement for table {tableName} with columns: {columns}")
-    insertStr = f"INSERT INTO {tableName} ({", ".join(columns)}) VALUES "
-    paramStr = ", ".join(["?" for _ in range(len(columns))])
-    paramStr = "".join(["(", paramStr, ")"])
-    paramStr = ",\n".join([paramStr for _ in range(rowCount)])
-    return "".join([insertStr, paramStr, " ON CONFLICT DO NOTHING;"])
-
-def batch_metadata(pathData: list[tuple[Path, Path]]):
-    tableName = "photo"
-    columns = ("filename", "thumbnail", "camera_model", "lens", "date_taken", "exposure_time", "focal_length", "f_stop", "iso")
-    maxRows = BATCH_PARAM_LIMIT // len(columns)
-    photoData = []
+    rowStr = f"({", ".join("?" * len(columns))})"
+    return f"INSERT INTO {tableName} ({", ".join(columns)}) VALUES {",\n".join([rowStr] * rowCount)} ON CONFLICT DO NOTHING;"
+
+def batch_metadata(pathData: list[tuple[Path, Path]], metadata: dict[Path, list[str]]):
+    """
+    Inserts photo rows into D1 using only two statement shapes, full batches of `PHOTO_BATCH_ROWS`
+    rows and single rows, so D1 can reuse their prepared statements across calls.
+
+    The single-row statements for the remaining rows are sent together in one D1 `batch` request.
+    """
+    maxRows = PHOTO_BATCH_ROWS
+    fullBatches, tailRows = divmod(len(pathData), maxRows)
+    fullRows = fullBatches * maxRows
     batchedQueries = []
-    for i, paths in enumerate(pathData):
-        src, thumb = paths
-        photoData.extend([src.name, thumb.name, "OLYMPUS XA2", "NULL", "NULL", "NULL", "NULL", "NULL", "NULL"])
-        # If max params per query or final pair of path data reached
-        if (not (i+1) % maxRows) or (i == len(pathData) - 1): 
-            query = get_multi_insert_query(tableName, columns, maxRows if not (i+1) % maxRows else (i+1) % maxRows)
-            batchedQueries.append({"sql": query, "params": photoData})
-            photoData = []
-    batch_d1(batchedQueries)
-
-def batch_d1(batchedQueries: list[dict[str: str, str: list[str]]]) -> None:
+    for start in range(0, fullRows, maxRows):
+        photoData = [value for src, thumb in pathData[start:start + maxRows]
+                     for value in (src.name, thumb.name, *metadata.get(src, ROW_DEFAULT))]
+        batchedQueries.append({"sql": FULL_BATCH_SQL, "params": photoData})
+    # Remaining rows are sent one per statement rather than as a one-off partial batch
+    singleRowQuery = get_multi_insert_query(PHOTO_TABLE, PHOTO_COLUMNS, 1)
+    tailQueries = [{"sql": singleRowQuery, "params": [src.name, thumb.name, *metadata.get(src, ROW_DEFAULT)]}
+                   for src, thumb in pathData[fullRows:]]
+    if tailQueries:
+        batchedQueries.append({"batch": tailQueries})
+    logger.debug(f"Built {fullBatches} full batch and {tailRows} single row insert statements")
+    asyncio.run(batch_d1(batchedQueries))
+
+async def batch_d1(batchedQueries: list[dict[str, str | list]]) -> None:
     """
     Note that the D1/SQLite limit for bound parameters is 100.
     
     For a table with `c` columns, we can insert up to `r = 100 / c` rows per query.
+
+    Each query is sent as its own request over a shared HTTP/2 connection, with up to `D1_WORKERS` in flight at once.
+    A query is either a single `{"sql", "params"}` statement or a `{"batch": [...]}` of them.
     """
-    d1Url = f"https://api.cloudflare.com/client/v4/accounts/{os.getenv("CLOUDFLARE_ACCOUNT_ID")}/d1/database/{os.getenv("CLOUDFLARE_D1_ID")}/query"
-    apiToken = os.getenv("CLOUDFLARE_D1_TOKEN")
     logger.debug(f"Attempting batch of {len(batchedQueries)} queries")
+    limits = httpx.Limits(max_keepalive_connections=D1_POOL_CONNECTIONS)
+    transport = httpx.AsyncHTTPTransport(http2=True, limits=limits, retries=D1_RETRIES)
+    semaphore = asyncio.Semaphore(D1_WORKERS)
+    async with httpx.AsyncClient(headers=D1_HEADERS, transport=transport, timeout=httpx.Timeout(D1_TIMEOUT)) as client:
+        results = await asyncio.gather(*[post_d1_query(client, semaphore, query) for query in batchedQueries])
+    logger.info(f"{sum(results)}/{len(batchedQueries)} batch queries successful.")
+
+async def post_d1_query(client: httpx.AsyncClient, semaphore: asyncio.Semaphore, query: dict[str, str | list]) -> bool:
+    """
+    Sends a parameterised query (or batch of queries) to D1 in one request, returning whether it succeeded.
+
+    Responses in `D1_RETRY_STATUSES` are retried with exponential backoff; photo inserts use
+    ON CONFLICT DO NOTHING, so resending them is safe.
+    """
     try:
-        res = requests.post(d1Url, 
-                    headers= {
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {apiToken}",
-                    },
-                    json={
-                        "batch": batchedQueries
-                    })
-        logger.debug(f"HTTP {res.status_code}: {res.content.decode()}")
+        for attempt in range(D1_RETRIES + 1):
+            async with semaphore:
+                res = await client.post(D1_URL, json=query)
+            logger.debug(f"HTTP {res.status_code}: {res.content.decode()}")
+            if res.status_code not in D1_RETRY_STATUSES or attempt == D1_RETRIES:
+                break
+            await asyncio.sleep(D1_BACKOFF * 2 ** attempt)
         res.raise_for_status()
-        logger.info("Batch query successful.")
-    except requests.exceptions.RequestException as e:
+        return True
+    except httpx.HTTPError as e:
         logger.error(e)
+        return False
 
 def debug_sql(sqlQuery: str) -> str:
     return " ".join([sqlLine.strip() for sqlLine in sqlQuery.splitlines()])
 
 def query_d1(sqlQuery: str):
-    d1Url = f"https://api.cloudflare.com/client/v4/accounts/{os.getenv("CLOUDFLARE_ACCOUNT_ID")}/d1/database/{os.getenv("CLOUDFLARE_D1_ID")}/query"
-    apiToken = os.getenv("CLOUDFLARE_D1_TOKEN")
     try:
         logger.info(f"Querying D1 with SQL string: {debug_sql(sqlQuery)}")
-        res = requests.post(d1Url, 
-                    headers= {
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {apiToken}",
-                    },
+        res = httpx.post(D1_URL,
+                    headers=D1_HEADERS,
                     json={
                         "sql": sqlQuery
                     })
         res.raise_for_status()
         logger.info(f"HTTP {res.status_code}: {res.content.decode()}")
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logger.error(e)
 
 def create_photo_table():
@@ -266,4 +765,5 @@ def create_photo_collection_table():
     query_d1(queryString)
 
 if __name__ == "__main__":
+    mp.freeze_support()
     main()
\ No newline at end of file